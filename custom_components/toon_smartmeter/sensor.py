@@ -3,12 +3,14 @@ from __future__ import annotations
 
 import asyncio
 from datetime import timedelta
-from functools import reduce
+from functools import partial
+import hashlib
 import logging
+from time import monotonic
 from typing import Final
 
 import aiohttp
-import async_timeout
+import orjson
 import voluptuous as vol
 
 from homeassistant.components.sensor import (
@@ -21,29 +23,48 @@ from homeassistant.const import (
     CONF_HOST,
     CONF_PORT,
     CONF_RESOURCES,
+    CONF_SCAN_INTERVAL,
     DEVICE_CLASS_ENERGY,
     DEVICE_CLASS_GAS,
     DEVICE_CLASS_POWER,
     ENERGY_KILO_WATT_HOUR,
+    EVENT_HOMEASSISTANT_STOP,
     POWER_WATT,
     VOLUME_CUBIC_METERS,
 
 )
-from homeassistant.helpers.aiohttp_client import async_get_clientsession
+from homeassistant.core import callback
 import homeassistant.helpers.config_validation as cv
-from homeassistant.helpers.entity import Entity
-from homeassistant.util import Throttle, dt
+from homeassistant.helpers.update_coordinator import (
+    CoordinatorEntity,
+    DataUpdateCoordinator,
+    UpdateFailed,
+)
 
 BASE_URL = "http://{0}:{1}/hdrv_zwave?action=getDevices.json"
 _LOGGER = logging.getLogger(__name__)
 
 MIN_TIME_BETWEEN_UPDATES = timedelta(seconds=10)
+SLOW_TIME_BETWEEN_UPDATES = timedelta(seconds=60)
+SHARED_FETCH_WINDOW = timedelta(seconds=1)
+
+MAX_PREALLOCATED_BODY = 1 << 20
 
 SENSOR_PREFIX = "Toon "
 ATTR_MEASUREMENT = "measurement"
 ATTR_SECTION = "section"
 
-SENSOR_LIST = {
+DEV_P1_1 = "dev_15.1"
+DEV_P1_2 = "dev_15.2"
+DEV_P1_4 = "dev_15.4"
+DEV_P1_5 = "dev_15.5"
+DEV_P1_6 = "dev_15.6"
+DEV_P1_7 = "dev_15.7"
+DEV_P1_8 = "dev_15.8"
+DEV_SOLAR = "dev_20.export"
+DEV_WATER_9 = "dev_27.9"
+
+SENSOR_LIST = frozenset({
     "gasused",
     "gasusedcnt",
     "elecusageflowpulse",
@@ -61,7 +82,7 @@ SENSOR_LIST = {
     "heat",
     "waterflow",
     "waterusedcnt",
-}
+})
 
 SENSOR_TYPES: Final[tuple[SensorEntityDescription, ...]] = (
     SensorEntityDescription(
@@ -190,13 +211,51 @@ SENSOR_TYPES: Final[tuple[SensorEntityDescription, ...]] = (
     ),
 )
 
+# Maps each sensor key to (device, field, divisor) in the getDevices.json payload.
+SENSOR_SPEC: Final[dict[str, tuple[str, str, float]]] = {
+    # gas verbruik laatste uur
+    "gasused": (DEV_P1_1, "CurrentGasFlow", 1000.0),
+    # gas verbruik teller laatste uur
+    "gasusedcnt": (DEV_P1_1, "CurrentGasQuantity", 1000.0),
+    # elec verbruik puls
+    "elecusageflowpulse": (DEV_P1_2, "CurrentElectricityFlow", 1.0),
+    # elec verbruik teller puls
+    "elecusagecntpulse": (DEV_P1_2, "CurrentElectricityQuantity", 1000.0),
+    # elec verbruik hoog/normaal
+    "elecusageflowhigh": (DEV_P1_4, "CurrentElectricityFlow", 1.0),
+    # elec verbruik teller hoog/normaal
+    "elecusagecnthigh": (DEV_P1_4, "CurrentElectricityQuantity", 1000.0),
+    # elec teruglever hoog/normaal
+    "elecprodflowhigh": (DEV_P1_5, "CurrentElectricityFlow", 1.0),
+    # elec teruglever teller hoog/normaal
+    "elecprodcnthigh": (DEV_P1_5, "CurrentElectricityQuantity", 1000.0),
+    # elec verbruik laag
+    "elecusageflowlow": (DEV_P1_6, "CurrentElectricityFlow", 1.0),
+    # elec verbruik teller laag
+    "elecusagecntlow": (DEV_P1_6, "CurrentElectricityQuantity", 1000.0),
+    # elec teruglever laag
+    "elecprodflowlow": (DEV_P1_7, "CurrentElectricityFlow", 1.0),
+    # elec teruglever teller laag
+    "elecprodcntlow": (DEV_P1_7, "CurrentElectricityQuantity", 1000.0),
+    # heat
+    "heat": (DEV_P1_8, "CurrentHeatQuantity", 1000.0),
+    # zon op toon
+    "elecsolar": (DEV_SOLAR, "CurrentElectricityFlow", 1.0),
+    # zon op toon teller
+    "elecsolarcnt": (DEV_SOLAR, "CurrentElectricityQuantity", 1000.0),
+    # water op toon, reported per hour and shown per minute
+    "waterflow": (DEV_WATER_9, "CurrentWaterFlow", 60.0),
+    # water op toon teller
+    "waterusedcnt": (DEV_WATER_9, "CurrentWaterQuantity", 1000.0),
+}
+
 
 PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend(
     {
         vol.Required(CONF_HOST): cv.string,
         vol.Optional(CONF_PORT, default=80): cv.positive_int,
         vol.Required(CONF_RESOURCES, default=list(SENSOR_LIST)): vol.All(
-            cv.ensure_list, [vol.In(SENSOR_LIST)]
+            cv.ensure_list, [vol.In(SENSOR_LIST)], frozenset
         ),
     }
 )
@@ -205,192 +264,265 @@ PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend(
 async def async_setup_platform(hass, config, async_add_entities, discovery_info=None):
     """Setup the Toon Smart Meter sensors."""
 
-    session = async_get_clientsession(hass)
-    data = ToonSmartMeterData(session, config.get(CONF_HOST), config.get(CONF_PORT))
-    await data.async_update()
+    data = ToonSmartMeterData(config.get(CONF_HOST), config.get(CONF_PORT))
+
+    async def async_close_session(event):
+        """Close the Toon session when Home Assistant stops."""
+        await data.async_close()
+
+    hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, async_close_session)
+
+    fast_interval = max(
+        config.get(CONF_SCAN_INTERVAL, MIN_TIME_BETWEEN_UPDATES),
+        MIN_TIME_BETWEEN_UPDATES,
+    )
+    # Flows change continuously, counters at most once a minute. Both tiers share
+    # one fetch, the counter tier reuses whatever the flow tier polled recently.
+    coordinators = {
+        False: DataUpdateCoordinator(
+            hass,
+            _LOGGER,
+            name="toon",
+            update_method=partial(data.async_update, max_age=SHARED_FETCH_WINDOW),
+            update_interval=fast_interval,
+        ),
+        True: DataUpdateCoordinator(
+            hass,
+            _LOGGER,
+            name="toon counters",
+            update_method=partial(data.async_update, max_age=fast_interval),
+            update_interval=max(fast_interval, SLOW_TIME_BETWEEN_UPDATES),
+        ),
+    }
 
     # Create a new sensor for each sensor type.
     entities = []
+    used = set()
+    wanted = config[CONF_RESOURCES]
     for description in SENSOR_TYPES:
-        if description.key in config[CONF_RESOURCES]:
-            sensor = ToonSmartMeterSensor(description, data)
-            entities.append(sensor)
-    async_add_entities(entities, True)
+        if description.key not in wanted:
+            continue
+        is_counter = description.state_class == STATE_CLASS_TOTAL_INCREASING
+        if is_counter not in used:
+            await coordinators[is_counter].async_refresh()
+            used.add(is_counter)
+        sensor = ToonSmartMeterSensor(description, coordinators[is_counter])
+        entities.append(sensor)
+    async_add_entities(entities, False)
     return True
 
 
+def _validate(value):
+    """Return None if the output from the Toon is NaN (happens after a reboot).
+
+    An unknown state keeps NaN out of the recorder without the drop to 0 that
+    total_increasing statistics would treat as a meter reset.
+    """
+    value = float(value)
+    # NaN is the only float that does not compare equal to itself.
+    return None if value != value else value
+
+
+def _get_scaled(energy, path, field, div):
+    """Return a field of a Toon device scaled by div, or None if the device is missing."""
+    node = energy.get(path)
+    if node is None:
+        return None
+    value = _validate(node[field])
+    if value is None:
+        return None
+    return value / div
+
+
+def _rounded(extract, ndigits):
+    """Wrap an extractor so its result is rounded to ndigits."""
+
+    def _extract(energy):
+        value = extract(energy)
+        if value is None:
+            return None
+        return round(value, ndigits)
+
+    return _extract
+
+
 # pylint: disable=abstract-method
 class ToonSmartMeterData(object):
-    """Handle Toon object and limit updates."""
+    """Handle Toon object and fetch data for the update coordinator."""
+
+    __slots__ = ("_session", "_url", "_data", "_last_hash", "_last_fetch", "_lock")
 
-    def __init__(self, session, host, port):
+    def __init__(self, host, port):
         """Initialize the data object."""
 
-        self._session = session
+        self._session = self._create_session()
         self._url = BASE_URL.format(host, port)
         self._data = None
-
-    @Throttle(MIN_TIME_BETWEEN_UPDATES)
-    async def async_update(self):
-        """Download and update data from Toon."""
+        self._last_hash = None
+        self._last_fetch = 0.0
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def _create_session():
+        """Create a single-connection session that keeps one warm socket to the Toon."""
+        connector = aiohttp.TCPConnector(
+            limit=1, keepalive_timeout=75, enable_cleanup_closed=True
+        )
+        return aiohttp.ClientSession(
+            connector=connector,
+            headers={"Connection": "keep-alive"},
+            timeout=aiohttp.ClientTimeout(
+                total=5, connect=1, sock_connect=1, sock_read=2
+            ),
+        )
+
+    async def async_update(self, max_age=timedelta(0)):
+        """Return the latest data from Toon.
+
+        Data fetched less than max_age ago is reused, so coordinators that
+        tick at the same time share a single request.
+        """
+
+        async with self._lock:
+            if (
+                self._data is not None
+                and monotonic() - self._last_fetch < max_age.total_seconds()
+            ):
+                return self._data
+            data = await self._async_fetch()
+            self._last_fetch = monotonic()
+            return data
+
+    @staticmethod
+    async def _async_read(response):
+        """Read the response body, in a single read when its length is known."""
+        length = response.content_length
+        # Content-Length is the encoded size, so only trust it for plain bodies.
+        if (
+            "Content-Encoding" not in response.headers
+            and length
+            and length < MAX_PREALLOCATED_BODY
+        ):
+            return await response.content.readexactly(length)
+        return await response.read()
+
+    async def _async_get(self):
+        """Request the device list and return the response with its body."""
+        async with self._session.get(self._url) as response:
+            return response, await self._async_read(response)
+
+    async def _async_fetch(self):
+        """Download and return the latest data from Toon."""
 
         try:
-            with async_timeout.timeout(5):
-                response = await self._session.get(
-                    self._url, headers={"Accept-Encoding": "identity"}
-                )
-        except aiohttp.ClientError:
-            _LOGGER.error("Cannot poll Toon using url: %s", self._url)
-            return
-        except asyncio.TimeoutError:
-            _LOGGER.error(
-                "Timeout error occurred while polling Toon using url: %s", self._url
-            )
-            return
+            try:
+                response, raw = await self._async_get()
+            except aiohttp.ServerDisconnectedError:
+                # The kept-alive socket went stale, retry once on a fresh connector.
+                await self._session.close()
+                self._session = self._create_session()
+                response, raw = await self._async_get()
+        except asyncio.IncompleteReadError as err:
+            raise UpdateFailed(
+                f"Incomplete response from Toon using url: {self._url}"
+            ) from err
+        except aiohttp.ServerDisconnectedError as err:
+            raise UpdateFailed(
+                f"Toon closed the connection using url: {self._url}"
+            ) from err
+        except asyncio.TimeoutError as err:
+            raise UpdateFailed(
+                f"Timeout error occurred while polling Toon using url: {self._url}"
+            ) from err
+        except aiohttp.ClientError as err:
+            raise UpdateFailed(f"Cannot poll Toon using url: {self._url}") from err
         except Exception as err:
-            _LOGGER.error("Unknown error occurred while polling Toon: %s", err)
             self._data = None
-            return
+            raise UpdateFailed(
+                f"Unknown error occurred while polling Toon: {err}"
+            ) from err
 
         try:
-            self._data = await response.json(content_type="text/javascript")
+            digest = hashlib.blake2b(raw, digest_size=16).digest()
+            if digest == self._last_hash and self._data is not None:
+                # Unchanged payload, hand back the same object so sensors can skip it.
+                return self._data
+            self._data = orjson.loads(raw)
+            self._last_hash = digest
             _LOGGER.debug("Data received from Toon: %s", self._data)
-        except Exception as err:
-            _LOGGER.error("Cannot parse data received from Toon: %s", err)
+        except orjson.JSONDecodeError as err:
             self._data = None
+            self._last_hash = None
+            raise UpdateFailed(
+                f"Cannot parse data received from Toon ({response.content_type}): {err}"
+            ) from err
 
-    @property
-    def latest_data(self):
-        """Return the latest data object."""
-        if self._data:
-            return self._data
-        return None
+        if not isinstance(self._data, dict):
+            self._data = None
+            self._last_hash = None
+            raise UpdateFailed(
+                f"Unexpected data received from Toon ({response.content_type}): "
+                "expected a JSON object"
+            )
+
+        return self._data
 
+    async def async_close(self):
+        """Close the session to the Toon."""
+        await self._session.close()
 
-class ToonSmartMeterSensor(SensorEntity):
+
+class ToonSmartMeterSensor(CoordinatorEntity, SensorEntity):
     """Representation of a Smart Meter connected to Toon."""
 
-    def __init__(self, description: SensorEntityDescription, data):
+    def __init__(self, description: SensorEntityDescription, coordinator):
         """Initialize the sensor."""
+        super().__init__(coordinator)
         self.entity_description = description
-        self._data = data
-
-        self._state = None
 
         self._type = self.entity_description.key
-        self._attr_icon = self.entity_description.icon
+        path, field, divisor = SENSOR_SPEC[self._type]
+        self._extract = partial(_get_scaled, path=path, field=field, div=divisor)
+        if self._type == "waterflow":
+            self._extract = _rounded(self._extract, 1)
         self._attr_name = SENSOR_PREFIX + self.entity_description.name
-        self._attr_state_class = self.entity_description.state_class
-        self._attr_native_unit_of_measurement = self.entity_description.native_unit_of_measurement
-        self._attr_device_class = self.entity_description.device_class
         self._attr_unique_id = f"{SENSOR_PREFIX}_{self._type}"
 
-        self._discovery = False
-        self._dev_id = {}
-
-    def _validateOutput(self, value):
-        """Return 0 if the output from the Toon is NaN (happens after a reboot)"""
-        try:
-            if value.lower() == "nan":
-                value = 0    @property
-        except:
-            return value
-
-        return value
+        self._update_state()
+        self._last_seen = coordinator.data
 
-    @property
-    def state(self):
-        """Return the state of the sensor. (total/current power consumption/production or total gas used)"""
-        return self._state
+    @callback
+    def _handle_coordinator_update(self) -> None:
+        """Handle updated data from the coordinator."""
+        if self.coordinator.last_update_success:
+            if self.coordinator.data is self._last_seen:
+                return
+            self._last_seen = self.coordinator.data
+        else:
+            self._last_seen = None
+        self._update_state()
+        super()._handle_coordinator_update()
 
-    async def async_update(self):
-        """Get the latest data and use it to update our sensor state."""
+    def _update_state(self):
+        """Use the latest coordinator data to update our sensor state."""
 
-        await self._data.async_update()
-        energy = self._data.latest_data
+        energy = self.coordinator.data
 
         if not energy:
             return
-        
-        p1_device = "dev_15"
-        water_device = "dev_27"
-        solar_device = "dev_20.export"
-        
-        """gas verbruik laatste uur"""
-        if self._type == "gasused":
-            self._state = float(energy[p1_device + ".1"]["CurrentGasFlow"]) / 1000
-
-            """gas verbruik teller laatste uur"""
-        elif self._type == "gasusedcnt":
-            self._state = float(energy[p1_device + ".1"]["CurrentGasQuantity"]) / 1000
-            
-            """elec verbruik puls"""
-        elif self._type == "elecusageflowpulse":
-            self._state = energy[p1_device + ".2"]["CurrentElectricityFlow"]
-
-            """elec verbruik teller puls"""
-        elif self._type == "elecusagecntpulse":
-            self._state = float(energy[p1_device + ".2"]["CurrentElectricityQuantity"]) / 1000
-            
-            """elec verbruik laag"""
-        elif self._type == "elecusageflowlow":
-            self._state = energy[p1_device + ".6"]["CurrentElectricityFlow"]
-            
-            """elec verbruik teller laag"""
-        elif self._type == "elecusagecntlow":
-            self._state = float(energy[p1_device + ".6"]["CurrentElectricityQuantity"] ) / 1000
-
-            """elec verbruik hoog/normaal"""
-        elif self._type == "elecusageflowhigh":
-            self._state = energy[p1_device + ".4"]["CurrentElectricityFlow"]
-
-            """elec verbruik teller hoog/normaal"""
-        elif self._type == "elecusagecnthigh":
-            self._state = float(energy[p1_device + ".4"]["CurrentElectricityQuantity"]) / 1000
-
-            """elec teruglever laag"""
-        elif self._type == "elecprodflowlow":
-            self._state = energy[p1_device + ".7"]["CurrentElectricityFlow"]
-
-            """elec teruglever teller laag"""
-        elif self._type == "elecprodcntlow":
-            self._state = float(energy[p1_device + ".7"]["CurrentElectricityQuantity"]) / 1000
-
-            """elec teruglever hoog/normaal"""
-        elif self._type == "elecprodflowhigh":
-            self._state = energy[p1_device + ".5"]["CurrentElectricityFlow"]
- 
-            """elec teruglever teller hoog/normaal"""
-        elif self._type == "elecprodcnthigh":
-            self._state = float(energy[p1_device + ".5"]["CurrentElectricityQuantity"]) / 1000
-
-            """zon op toon"""
-        elif self._type == "elecsolar":
-            self._state = energy[solar_device]["CurrentElectricityFlow"]
-
-            """zon op toon teller"""
-        elif self._type == "elecsolarcnt":
-            self._state = float(energy[solar_device]["CurrentElectricityQuantity"]) / 1000
-
-            """heat"""
-        elif self._type == "heat":
-            self._state = float(energy[p1_device + ".8"]["CurrentHeatQuantity"]) / 1000
-
-            """water op toon"""
-        elif self._type == 'waterflow':
-            self._state = round((float(energy[water_device + ".9"]["CurrentWaterFlow"])/60), 1)
-
-            """water op toon teller"""
-        elif self._type == 'waterusedcnt':
-            self._state = float(energy[water_device + ".9"]["CurrentWaterQuantity"])/1000
-        
-            
-        _LOGGER.debug("Device: {} State: {}".format(self._type, self._state))
 
-def safe_get(_dict, keys, default=None):
-    def _reducer(d, key):
-        if isinstance(d, dict):
-            return d.get(key, default)
-        return default
+        try:
+            self._attr_native_value = self._extract(energy)
+        except (KeyError, TypeError, ValueError) as err:
+            _LOGGER.error("Cannot read %s from data received from Toon: %s", self._type, err)
+            self._attr_native_value = None
+
+        _LOGGER.debug("Device: %s State: %s", self._type, self._attr_native_value)
 
-    return reduce(_reducer, keys, _dict)
+
+def safe_get(_dict, keys, default=None):
+    for key in keys:
+        if not isinstance(_dict, dict):
+            return default
+        _dict = _dict.get(key, default)
+    return _dict